@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Gunicorn configuration for running the LUCID backend outside of Vercel.
+
+Vercel's Python runtime ignores this file; it is only used when self-hosting, e.g.:
+
+    gunicorn -c gunicorn.conf.py lucid:app
+
+The /lucid endpoint spends nearly all of its time waiting on the OpenAI API, so
+concurrency comes from threads (or greenlets) inside a small number of worker
+processes rather than from many processes.
+"""
+import multiprocessing
+import os
+
+# Process / thread layout: each gthread worker serves `threads` requests concurrently,
+# which suits an I/O-bound proxy waiting on OpenAI. The blocking OpenAI call releases the
+# GIL while it waits on the socket, so threads give event-loop-like overlap for this
+# workload without porting the Flask/WSGI app to an async framework.
+# Defaults to Gunicorn's usual (2 x CPUs) + 1 processes, capped at 4: the threads provide the
+# concurrency, and every extra process holds its own HTTP pool and response cache. CPUs are counted
+# from the scheduler affinity where available, since cpu_count() reports every host core inside
+# containers. Set WEB_CONCURRENCY to override.
+_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else multiprocessing.cpu_count()
+workers = int(os.getenv('WEB_CONCURRENCY', min(_CPUS * 2 + 1, 4)))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = 16
+
+# For very high numbers of simultaneous chats, set GUNICORN_WORKER_CLASS=gevent (requires
+# `pip install gevent`). Gunicorn's gevent worker monkey-patches the standard library when the
+# worker starts, so the requests session becomes cooperative and each worker can hold this many
+# connections -- provided lucid (and with it requests/urllib3/ssl) is first imported *after* that
+# patching, which is why preloading is disabled for gevent below.
+worker_connections = 1000
+
+# Import the app once in the master process before forking, so module-level state
+# (parsed configuration, the shared HTTP session, etc.) is built a single time and
+# shared copy-on-write across workers. Anything mutated at runtime must be lock-protected.
+# Not for gevent: the master would import ssl and build the session before the worker patches them.
+preload_app = worker_class != 'gevent'
+
+# Size lucid's pool of kept-alive OpenAI connections (LUCID_HTTP_POOL_SIZE) to the number of
+# requests a worker serves concurrently, so in-flight calls never open a connection only to
+# discard it afterwards. Set here, before lucid is imported; an explicit setting still wins.
+os.environ.setdefault('LUCID_HTTP_POOL_SIZE', str(worker_connections if worker_class == 'gevent' else threads))
+
+# With gthread and gevent workers this is not a per-request limit: those workers heartbeat to the
+# master independently of request duration, so `timeout` only restarts a worker that has stopped
+# responding altogether. A /lucid call is bounded by the app itself instead (30 s OpenAI read
+# timeout, answered with a 504, plus any retries of failed connections or 503s).
+timeout = 35
+
+# Keep client connections open between requests (seconds)
+keepalive = 75
+
+def post_worker_init(worker):
+    """
+    Warm each worker's pooled connection to OpenAI in the background as soon as it starts, so the
+    first participant request does not pay the TLS handshake. Runs after the fork, so every worker
+    gets its own socket (warming during preload would share one socket between all workers).
+    The helper is looked up on the module the loaded Flask app came from, so the hook does not
+    depend on the app being started as `lucid:app`.
+    """
+    import sys
+    import threading
+    app_module = sys.modules.get(getattr(worker.wsgi, 'import_name', ''))
+    warm_up = getattr(app_module, '_warm_openai_connection', None)
+    if warm_up is not None:
+        threading.Thread(target=warm_up, name='openai-warmup', daemon=True).start()
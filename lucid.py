@@ -7,106 +7,364 @@ Handles CORS, fetches configuration from environment variables, makes API calls,
 and returns responses. Includes a root endpoint to display deployment status
 and the necessary Qualtrics URL.
 """
-from flask import Flask, request, jsonify, make_response
-import json
+from flask import Flask, Response, request
+import orjson # Fast C/Rust JSON parsing and serialization (bytes in, bytes out)
 import os      # Used for accessing environment variables (API keys, config)
 import requests # Used for making HTTP requests to the OpenAI API
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import html
+import re
+import hashlib
+import gzip
+import functools
+import logging
+import threading
+import collections
 
 # Initialize the Flask application
 app = Flask(__name__)
 
+# --- Logging ---
+# Module logger writing to stderr (visible in Vercel Function Logs). The level is read once from
+# LUCID_LOG_LEVEL (or the generic LOG_LEVEL), default WARNING; messages use lazy %-formatting, so
+# disabled levels cost nothing.
+def _resolve_log_level(raw):
+    """
+    Returns the numeric logging level for a level name ('debug', 'INFO', ...) or number ('20'),
+    or None if the value is not a valid level. Other tools also read LOG_LEVEL and may set values
+    such as 'trace' or 'verbose', which must not stop the app from importing.
+    """
+    value = raw.strip().upper()
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value) # An int for known names, otherwise a 'Level ...' string
+    return level if isinstance(level, int) else None
+
+_LOG_LEVEL_SETTING = os.getenv('LUCID_LOG_LEVEL') or os.getenv('LOG_LEVEL') or 'WARNING'
+_LOG_LEVEL = _resolve_log_level(_LOG_LEVEL_SETTING)
+logger = logging.getLogger('lucid')
+logger.setLevel(_LOG_LEVEL if _LOG_LEVEL is not None else logging.WARNING)
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+    logger.addHandler(_log_handler)
+    logger.propagate = False # Avoid duplicate lines if the host also configures the root logger
+if _LOG_LEVEL is None:
+    logger.warning("[ENV] Unknown log level '%s', using WARNING.", _LOG_LEVEL_SETTING)
+
+# Reject request bodies larger than this before parsing them. A declared Content-Length is checked
+# up front; for uploads without one (chunked), Werkzeug only stops reading at the limit without
+# raising, so lucid() treats a body that reaches the limit as too large.
+# Override with LUCID_MAX_BODY (bytes); the 256 KB default is ample for a chat history.
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('LUCID_MAX_BODY', 256 * 1024))
+# Upper bound on the number of chat messages forwarded to OpenAI in a single request.
+# Override with LUCID_MAX_MESSAGES; longer histories are rejected with 413 before any upstream call.
+_MAX_MESSAGES = int(os.getenv('LUCID_MAX_MESSAGES', 200))
+
+# --- Outbound HTTP Session ---
+# One pooled session per process, so warm instances reuse the kept-alive TLS connection to
+# OpenAI instead of paying a new TCP + TLS handshake on every /lucid call.
+# All traffic goes to a single host, so one host pool is enough; its size should match the number
+# of concurrent requests per process so no in-flight call has to open, and then discard, an extra
+# connection. Override with LUCID_HTTP_POOL_SIZE (gunicorn.conf.py sets it from its worker settings).
+_HTTP_POOL_SIZE = int(os.getenv('LUCID_HTTP_POOL_SIZE', 16))
+# Only failures where OpenAI cannot have generated (and billed) a completion are retried: refused
+# or failed connections, and 503 (service overloaded). 429 is not retried (quota errors are
+# permanent, and rate limits need Retry-After waits longer than a participant should sit through),
+# nor are 502/504, since the POST may already have produced a completion. Read timeouts are
+# re-raised unchanged (read=False), so a slow completion still fails after one 30 s wait as a
+# Timeout (504) rather than a connection error.
+_HTTP_RETRY = Retry(
+    total=2,
+    read=False,
+    backoff_factor=0.5, # urllib3 2.x: first retry immediately, the second after 1 s
+    status_forcelist=(503,),
+    allowed_methods=frozenset({'POST'}),
+    respect_retry_after_header=False, # Keep the added wait bounded by the backoff above
+    raise_on_status=False # Hand the final error response back to lucid() instead of raising
+)
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=_HTTP_POOL_SIZE, max_retries=_HTTP_RETRY))
+
+def _warm_openai_connection():
+    """
+    Opens (and returns to the pool) a kept-alive TLS connection to the OpenAI API, so the first
+    /lucid call in a fresh process skips the DNS + TCP + TLS setup. Must run after any fork (e.g.
+    from Gunicorn's post_worker_init hook), never at import, since sockets must not be shared
+    across forked workers. Failures are harmless: the first real request just connects itself.
+    """
+    if not _OPENAI_API_KEY:
+        return # Nothing will call OpenAI (and the session has no usable Authorization header)
+    try:
+        _SESSION.head('https://api.openai.com/v1/models', timeout=2).close()
+        logger.debug("[HTTP] Warmed connection to the OpenAI API.")
+    except requests.exceptions.RequestException as e:
+        logger.debug("[HTTP] OpenAI connection warm-up failed: %s", e)
+
+# --- Optional Response Cache ---
+# Opt-in LRU of generated text for *seeded* requests, keyed on a hash of the exact OpenAI payload
+# (model, full message history, temperature, seed). A seed signals that the researcher wants
+# reproducible replies, so an identical repeat (e.g. a participant re-submitting after a reload)
+# can be answered without another paid round-trip. Disabled unless LUCID_RESPONSE_CACHE_SIZE > 0.
+# Shared by all request threads, so access is guarded by a lock.
+_RESPONSE_CACHE_SIZE = int(os.getenv('LUCID_RESPONSE_CACHE_SIZE', 0))
+_RESPONSE_CACHE = collections.OrderedDict()
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+def _response_cache_key(payload_bytes):
+    """
+    Returns a compact digest identifying a serialized OpenAI payload, or None if caching is disabled.
+    The bytes are hashed as sent upstream: lucid() fixes the top-level key order, but message dicts
+    keep the client's key order, so the same history with reordered keys is simply a cache miss.
+    """
+    if not _RESPONSE_CACHE_SIZE:
+        return None
+    return hashlib.blake2b(payload_bytes, digest_size=16).digest()
+
+def _response_cache_get(key):
+    """
+    Returns the cached generated text for a key (refreshing its recency), or None.
+    """
+    if key is None:
+        return None
+    with _RESPONSE_CACHE_LOCK:
+        text = _RESPONSE_CACHE.get(key)
+        if text is not None:
+            _RESPONSE_CACHE.move_to_end(key)
+        return text
+
+def _response_cache_put(key, text):
+    """
+    Stores generated text under a key, evicting the least recently used entries beyond the limit.
+    """
+    if key is None or not isinstance(text, str):
+        return
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE[key] = text
+        _RESPONSE_CACHE.move_to_end(key)
+        while len(_RESPONSE_CACHE) > _RESPONSE_CACHE_SIZE:
+            _RESPONSE_CACHE.popitem(last=False)
+
+# --- OpenAI API Key ---
+# Read once at startup; environment variables are fixed for the life of the process.
+# Checks both uppercase and lowercase env var names. A missing key is logged rather than raised,
+# so the root status page still renders; /lucid then answers with a 500 Configuration Error.
+_OPENAI_API_KEY = (
+    os.getenv('OPENAI_API_KEY') or  # Vercel / production (Screaming Snake Case)
+    os.getenv('openai_api_key')     # legacy/local (lower snake case)
+)
+if not _OPENAI_API_KEY:
+    logger.critical("[ENV] Neither os.getenv('OPENAI_API_KEY') nor os.getenv('openai_api_key') returned a value!")
+
+# OpenAI Chat Completions endpoint. The static headers for every request to it are set once as
+# session defaults (the key never changes at runtime), so no per-call headers need to be merged.
+_OPENAI_URL = 'https://api.openai.com/v1/chat/completions'
+_SESSION.headers.update({
+    'Content-Type': 'application/json',
+    'Authorization': f'Bearer {_OPENAI_API_KEY}', # Use API key for authorization
+    'Accept-Encoding': 'gzip' # Compressed completions; requests decompresses transparently
+})
+
 # --- Configuration & CORS ---
 
-def get_allowed_origins_config():
+def _parse_allowed_origins():
     """
-    Reads the ALLOWED_ORIGINS environment variable and parses it into a list.
+    Reads the ALLOWED_ORIGINS environment variable and parses it into a tuple.
     Defaults to allowing all origins ('*') if the variable is not set.
-    Uses print for logging and visible in Vercel Function Logs.
+    Runs once at import time; environment variables do not change for the life of the process.
+    Logs via the module logger (visible in Vercel Function Logs).
     """
     origins_str = os.getenv('ALLOWED_ORIGINS')
-    print(f"[DEBUG ENV] Raw ALLOWED_ORIGINS: '{origins_str}'") # Vercel Log
+    logger.debug("[ENV] Raw ALLOWED_ORIGINS: '%s'", origins_str)
 
     if not origins_str:
         # Default to wildcard if environment variable is missing or empty
-        print("[WARN ENV] ALLOWED_ORIGINS not set. Defaulting CORS to allow all ('*').") # Vercel Log
-        return ['*']
+        logger.warning("[ENV] ALLOWED_ORIGINS not set. Defaulting CORS to allow all ('*').")
+        return ('*',)
 
     # Parse comma-separated list, removing empty strings and stripping whitespace
-    allowed_list = [origin.strip() for origin in origins_str.split(',') if origin.strip()]
-    print(f"[DEBUG ENV] Parsed ALLOWED_ORIGINS: {allowed_list}") # Vercel Log
-    return allowed_list
+    allowed_origins = tuple(origin.strip() for origin in origins_str.split(',') if origin.strip())
+    logger.debug("[ENV] Parsed ALLOWED_ORIGINS: %s", allowed_origins)
+    return allowed_origins
 
-@app.before_request
-def handle_preflight():
+def _compile_origin_patterns(origins):
     """
-    Handles CORS preflight (OPTIONS) requests specifically for the /lucid endpoint.
-    Checks the request's Origin header against the ALLOWED_ORIGINS config
-    and returns appropriate CORS headers if allowed, or a 403 if denied.
-    Echoes back requested headers. Only adds 'Access-Control-Allow-Credentials'
-    when needed and with the value 'true'.
+    Compiles wildcard entries such as 'https://*.qualtrics.com' into a single regex alternation,
+    or returns None if there are none. A '*' matches any run of characters except '/', so it
+    can stand in for subdomains (or a port) but never spans into a path.
     """
-    # Intercept only OPTIONS requests targetting the main API endpoint
-    # UPDATED: Changed request.method.upper() == 'OPTIONS' to request.method == 'OPTIONS' (Flask normalizes it)
-    if request.method == 'OPTIONS' and request.path == '/lucid':
-        print(f"[INFO] Intercepting OPTIONS request for {request.path}") # Vercel Log
-        origin = request.headers.get('Origin') # Get the origin of the requesting domain
-        allowed_origins = get_allowed_origins_config() # Fetch the configured allowed origins
-
-        print(f"[DEBUG PREFLIGHT] Request Origin: '{origin}'") # Vercel Log
-        print(f"[DEBUG PREFLIGHT] Checking against Allowed: {allowed_origins}") # Vercel Log
-
-        ac_allow_origin = None # Initialize
-        send_credentials = False # Initialize
+    patterns = [o for o in origins if '*' in o and o != '*']
+    if not patterns:
+        return None
+    alternation = '|'.join('[^/]*'.join(re.escape(part) for part in p.split('*')) for p in patterns)
+    logger.debug("[ENV] Compiled ALLOWED_ORIGINS patterns: %s", patterns)
+    return re.compile(f'(?:{alternation})')
+
+# Parsed once per process: an immutable tuple (for display), a frozenset of literal origins for O(1)
+# membership checks, one compiled regex for any wildcard patterns, and whether '*' is configured
+_ALLOWED_ORIGINS = _parse_allowed_origins()
+_ALLOWED_ORIGINS_SET = frozenset(o for o in _ALLOWED_ORIGINS if '*' not in o)
+_ALLOWED_ORIGINS_RE = _compile_origin_patterns(_ALLOWED_ORIGINS)
+_ALLOW_ANY = '*' in _ALLOWED_ORIGINS
+
+def _is_origin_allowed(origin):
+    """
+    Returns True if the origin is listed literally in ALLOWED_ORIGINS or matches one of its
+    wildcard patterns. Does not consider the bare '*' wildcard (see _ALLOW_ANY).
+    """
+    if origin in _ALLOWED_ORIGINS_SET:
+        return True
+    return bool(origin) and _ALLOWED_ORIGINS_RE is not None and _ALLOWED_ORIGINS_RE.fullmatch(origin) is not None
 
-        # ---- decide origin & credentials ------------------------
-        if '*' in allowed_origins:
-            ac_allow_origin = '*'
-            send_credentials = False        # wildcard ⇒ no creds
-            print("[DEBUG PREFLIGHT] Policy: Allowed Wildcard (*), Credentials False") # Vercel Log
-        elif origin and origin in allowed_origins: # Added check for origin existence
-            ac_allow_origin = origin
-            send_credentials = True
-            print(f"[DEBUG PREFLIGHT] Policy: Allowed Specific Origin ({origin}), Credentials True") # Vercel Log
-        else:
-            # Origin not allowed by configuration
-            print(f"[WARN] Preflight origin '{origin}' denied by policy for /lucid.") # Vercel Log
-            return make_response('Origin not permitted for CORS preflight', 403)
+# CORS headers for the wildcard policy; identical for every response, so built once
+_WILDCARD_CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Vary': 'Origin'
+}
 
-        # ---- echo back ALL requested headers --------------------
-        # Retrieve the headers the browser wants to send in the actual request
-        req_hdrs = request.headers.get(
-            'Access-Control-Request-Headers', ''
-        )  # e.g. "X-Requested-With,Content-Type" or just "Content-Type" etc.
-        print(f"[DEBUG PREFLIGHT] Access-Control-Request-Headers received: '{req_hdrs}'") # Vercel Log
-
-        # Construct the response for the preflight request (204 No Content)
-        res = make_response('', 204)
-
-        # Build the core CORS headers
-        cors_headers = {
-            'Access-Control-Allow-Origin': ac_allow_origin,
-            'Access-Control-Allow-Methods': 'POST, OPTIONS', # Allowed methods for the actual request
-            # Allow the headers the browser requested, default to Content-Type if none specified
-            'Access-Control-Allow-Headers': req_hdrs if req_hdrs else 'Content-Type',
-            'Access-Control-Max-Age': '86400' # Cache preflight response for 1 day
-        }
-
-        # --- Add Allow-Credentials header ONLY if needed and with value 'true' ---
-        if send_credentials:
-            cors_headers['Access-Control-Allow-Credentials'] = 'true'
-            print("[DEBUG PREFLIGHT] Adding Access-Control-Allow-Credentials: true") # Vercel Log
-        else:
-             print("[DEBUG PREFLIGHT] Not adding Access-Control-Allow-Credentials header") # Vercel Log
+def _specific_origin_cors_headers(origin):
+    """
+    CORS headers for an explicitly allowed origin: echo the origin back and allow credentials.
+    """
+    return {
+        'Access-Control-Allow-Origin': origin,
+        'Vary': 'Origin',
+        'Access-Control-Allow-Credentials': 'true'
+    }
+
+@functools.lru_cache(maxsize=256)
+def _cors_decision(origin):
+    """
+    Applies the CORS policy to a request Origin (None if the header is absent).
+    Returns (origin_to_send, send_credentials, cors_headers); origin_to_send is None when the
+    origin is denied. Memoized per origin, so after the first request from an origin the whole
+    decision is one dict lookup; the returned headers dict is shared and must not be mutated.
+    """
+    if _ALLOW_ANY:
+        return '*', False, _WILDCARD_CORS_HEADERS # wildcard ⇒ no creds
+    if _is_origin_allowed(origin):
+        return origin, True, _specific_origin_cors_headers(origin)
+    return None, False, None
+
+# Preflight response headers. Browsers cache the preflight for Access-Control-Max-Age: Firefox
+# honours up to 24 hours, while Chromium clamps any larger value to 2 hours, so 24 hours costs
+# nothing there. Separately, the Cache-Control/Vary pair lets a CDN such as Vercel's edge answer
+# repeat preflights per origin and requested-header set without invoking the function at all; the
+# CDN copy is kept for 2 hours so ALLOWED_ORIGINS changes reach new visitors reasonably quickly.
+_PREFLIGHT_MAX_AGE = '86400'
+_PREFLIGHT_CDN_MAX_AGE = '7200'
+_PREFLIGHT_BASE_HEADERS = {
+    'Access-Control-Allow-Methods': 'POST, OPTIONS', # Allowed methods for the actual request
+    'Access-Control-Max-Age': _PREFLIGHT_MAX_AGE,
+    'Cache-Control': f'public, max-age={_PREFLIGHT_CDN_MAX_AGE}',
+    'Vary': 'Origin, Access-Control-Request-Headers'
+}
+
+@functools.lru_cache(maxsize=256)
+def _preflight_headers(ac_allow_origin, send_credentials, req_hdrs):
+    """
+    Complete header set for a successful preflight, as WSGI (name, value) pairs, memoized per
+    (allowed origin, credentials, Access-Control-Request-Headers). Browsers send only a few
+    distinct header lists, so a preflight is normally a cache hit.
+    """
+    headers = {
+        'Access-Control-Allow-Origin': ac_allow_origin,
+        **_PREFLIGHT_BASE_HEADERS,
+        # Allow the headers the browser requested, default to Content-Type if none specified
+        'Access-Control-Allow-Headers': req_hdrs if req_hdrs else 'Content-Type'
+    }
+    # Add Allow-Credentials header ONLY if needed and with value 'true'
+    if send_credentials:
+        headers['Access-Control-Allow-Credentials'] = 'true'
+    return tuple(headers.items())
+
+# --- Static Responses ---
+
+# HTML for the root status page. The only dynamic part is the {backend_url_for_qualtrics}
+# placeholder, so the template is split around it once at import into UTF-8 byte fragments, and
+# rendering is a single bytes join (no str formatting, no brace escaping in the CSS/JS).
+_ROOT_HTML_TEMPLATE = """
+<!DOCTYPE html><html lang="en">
+<head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>LUCID Backend Deployed</title>
+<style>
+    body { font-family: system-ui, -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Oxygen, Ubuntu, Cantarell, "Fira Sans", "Droid Sans", "Helvetica Neue", sans-serif; padding: 20px; line-height: 1.6; background-color: #f8f9fa; color: #212529; }
+    .container { max-width: 750px; margin: 40px auto; padding: 35px; border: 1px solid #dee2e6; border-radius: 8px; background-color: #ffffff; box-shadow: 0 4px 8px rgba(0,0,0,0.05); }
+    h1 { color: #0d6efd; border-bottom: 2px solid #0d6efd; padding-bottom: 10px; margin-bottom: 20px; }
+    h2 { color: #495057; margin-top: 30px; border-bottom: 1px solid #ced4da; padding-bottom: 8px;}
+    code { background-color: #e9ecef; padding: 0.2em 0.5em; border-radius: 4px; font-family: "SFMono-Regular", Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace; font-size: 0.9em; color: #d63384;}
+    .url-box { background-color: #f1f3f5; padding: 12px 18px; border: 1px solid #adb5bd; border-radius: 5px; font-family: "SFMono-Regular", Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace; word-wrap: break-word; margin-bottom: 15px; font-size: 1.05em; color: #0b5ed7; }
+    button { padding: 10px 18px; cursor: pointer; border-radius: 5px; border: none; background-color: #0d6efd; color: white; font-size: 15px; transition: background-color 0.2s ease; }
+    button:hover { background-color: #0b5ed7; }
+    .copied-message { color: #198754; font-weight: bold; display: none; margin-left: 10px;}
+    .important { background-color: #fff3cd; border: 1px solid #ffeeba; color: #664d03; padding: 15px 20px; border-radius: 5px; margin-top: 20px; }
+    .important code { background-color: #fde7a0; color: #664d03; }
+    ul { margin-top: 10px; padding-left: 20px; } li { margin-bottom: 5px; }
+    p { margin-bottom: 1rem; }
+</style>
+</head>
+<body><div class="container">
+    <h1>LUCID Backend Successfully Deployed!</h1>
+
+    <h2>Next Step: Configure Qualtrics</h2>
+    <p>To connect your Qualtrics survey to this backend:</p>
+    <ol>
+        <li><strong>Copy the full Backend URL below.</strong> This URL should reflect the main production domain when accessed via production. Use this URL for the <code>LUCIDBackendURL</code> Embedded Data field in Qualtrics.</li>
+        <li>In your Qualtrics Survey Flow, create or update the Embedded Data field named <code>LUCIDBackendURL</code> and paste this URL as its value.</li>
+    </ol>
+    <p><strong>Backend URL (Value for <code>LUCIDBackendURL</code>):</strong></p>
+    <div id="qualtricsUrlBox" class="url-box">{backend_url_for_qualtrics}</div>
+    <button onclick="copyUrl()">Copy Backend URL</button>
+    <span id="copiedMsg" class="copied-message">Copied!</span>
+</div>
+<script>function copyUrl() { const urlText = document.getElementById('qualtricsUrlBox').innerText; navigator.clipboard.writeText(urlText).then(() => { const msg = document.getElementById('copiedMsg'); msg.style.display = 'inline'; setTimeout(() => { msg.style.display = 'none'; }, 2500); }).catch(err => { console.error('Failed to copy: ', err); alert('Failed to copy URL.'); }); }</script>
+</body></html>
+"""
+_ROOT_HTML_PREFIX, _ROOT_HTML_SUFFIX = (
+    part.encode('utf-8') for part in _ROOT_HTML_TEMPLATE.split('{backend_url_for_qualtrics}')
+)
 
-        # Update response headers
-        res.headers.update(cors_headers)
+@functools.lru_cache(maxsize=8)
+def _render_root_page(backend_url_for_qualtrics):
+    """
+    Renders the root status page for an (already HTML-escaped) backend URL.
+    Returns (html_bytes, etag, gzip_bytes, gzip_etag). Only a handful of hostnames ever reach '/',
+    so results are memoized and repeat visits cost a dict lookup; the page is also compressed once
+    here, and each encoding gets its own ETag so browsers can revalidate either with a 304.
+    """
+    html_bytes = b''.join((_ROOT_HTML_PREFIX, backend_url_for_qualtrics.encode('utf-8'), _ROOT_HTML_SUFFIX))
+    digest = hashlib.md5(html_bytes, usedforsecurity=False).hexdigest()
+    gzip_bytes = gzip.compress(html_bytes, compresslevel=6, mtime=0) # mtime=0: identical bytes on every instance
+    return html_bytes, f'"{digest}"', gzip_bytes, f'"{digest}-gz"'
 
-        print(f"[INFO] Preflight OK for /lucid. Sending 204 with headers: {dict(res.headers)}") # Vercel Log
-        return res
+# Port that each scheme implies, and that request.url_root therefore leaves out of the host
+_DEFAULT_PORTS = {'http': '80', 'https': '443'}
 
-    # If not an OPTIONS request for /lucid, proceed to the actual route function
-    pass
+@functools.lru_cache(maxsize=8)
+def _backend_url_for(scheme, http_host, server_name, server_port, script_root):
+    """
+    Builds the HTML-escaped /lucid URL shown on the root page from raw WSGI environ values, matching
+    request.url_root: the Host header (or SERVER_NAME plus a non-default SERVER_PORT) without the
+    scheme's default port. The URL is what researchers paste into Qualtrics, so ':443' must not leak
+    in. Memoized per distinct set of values.
+    """
+    host = http_host or (f"{server_name}:{server_port}" if server_port else server_name)
+    default_port_suffix = ':' + _DEFAULT_PORTS.get(scheme, '')
+    if host.endswith(default_port_suffix):
+        host = host[:-len(default_port_suffix)]
+    return html.escape(f"{scheme}://{host}{script_root.rstrip('/')}/lucid") # Escape for safety
+
+# Serialized JSON bodies for the fixed /lucid error responses, built once at import
+_ERR_FORBIDDEN = orjson.dumps({'error': 'Forbidden', 'message': 'Origin not permitted.'})
+_ERR_NO_KEY = orjson.dumps({'error': 'Configuration Error', 'message': 'OpenAI API key not configured on server.'})
+_ERR_BODY_TOO_LARGE = orjson.dumps({'error': 'Payload Too Large', 'message': 'Request body exceeds the maximum allowed size.'})
+_ERR_EMPTY_MESSAGES = orjson.dumps({'error': 'Bad Request', 'message': 'Messages list is missing, empty, or invalid.'})
+_ERR_TOO_MANY_MESSAGES = orjson.dumps({'error': 'Payload Too Large', 'message': f'Messages list exceeds the maximum of {_MAX_MESSAGES} entries.'})
+_ERR_BAD_UPSTREAM_FORMAT = orjson.dumps({'error': 'Internal Server Error', 'message': 'Invalid response format from AI service.'})
+_ERR_TIMEOUT = orjson.dumps({'error': 'Gateway Timeout', 'message': 'Request to AI service timed out.'})
+_ERR_NETWORK = orjson.dumps({'error': 'Service Unavailable', 'message': 'Network error connecting to AI service.'})
+_ERR_BAD_JSON = orjson.dumps({'error': 'Bad Request', 'message': 'Invalid JSON format in request body.'})
+_ERR_INTERNAL = orjson.dumps({'error': 'Internal Server Error', 'message': 'An unexpected error occurred processing the request.'})
 
 # --- Application Routes ---
 
@@ -118,93 +376,133 @@ def hello_world():
     if deployed on Vercel (detects via VERCEL_URL env var).
     Also handles basic CORS headers for GET requests to the root.
     """
-    print("[INFO] Root route '/' accessed.") # Vercel Log
+    logger.info("Root route '/' accessed.")
     origin = request.headers.get('Origin')
-    allowed_origins = get_allowed_origins_config()
 
-    # Attempt to get the Vercel deployment URL from environment variables
     # --- Determine the correct backend URL using the incoming request context ---
-    backend_url_for_qualtrics = "[Error determining backend URL from request]" # Default/fallback
-    backend_url_base = "Unknown"
-    try:
-        # request.url_root gives "scheme://host:port/" - reflects how user accessed page
-        # Strip the trailing '/' and append our specific endpoint path.
-        backend_url_base = request.url_root.rstrip('/')
-        backend_url_for_qualtrics = f"{backend_url_base}/lucid"
-        backend_url_for_qualtrics = html.escape(backend_url_for_qualtrics) # Escape for safety
-        print(f"[DEBUG URL] Derived base from request.url_root: {backend_url_base}")
-        print(f"[DEBUG URL] Constructed Backend URL for Qualtrics: {backend_url_for_qualtrics}")
-    except Exception as e:
-        print(f"[ERROR URL] Failed to derive URL from request.url_root: {e}")
+    # Read straight from the WSGI environ (reflects how the user accessed the page) instead of
+    # going through request.url_root's parsing and quoting; the result is memoized per host.
+    environ = request.environ
+    backend_url_for_qualtrics = _backend_url_for(environ.get('wsgi.url_scheme', 'http'),
+                                                 environ.get('HTTP_HOST', ''),
+                                                 environ.get('SERVER_NAME', ''),
+                                                 environ.get('SERVER_PORT', ''),
+                                                 environ.get('SCRIPT_NAME', ''))
+    logger.debug("[URL] Constructed Backend URL for Qualtrics: %s", backend_url_for_qualtrics)
+
+    # --- Render the HTML Page (memoized per backend URL) ---
+    # Uses only: backend_url_for_qualtrics
+    html_bytes, etag, gzip_bytes, gzip_etag = _render_root_page(backend_url_for_qualtrics)
+    # Serve the precompressed page to clients that accept gzip (parsed, so 'gzip;q=0' is a refusal)
+    use_gzip = request.accept_encodings['gzip'] > 0
+    if use_gzip:
+        html_bytes, etag = gzip_bytes, gzip_etag
+
+    # Collect every response header first and hand them to the Response in one go:
+    # revalidation (browsers may store the page but must revalidate), basic CORS headers for the
+    # root route as well (credentials are allowed only if a specific origin matches), and a Vary
+    # covering both Origin and the Accept-Encoding negotiation above
+    headers = [('ETag', etag), ('Cache-Control', 'no-cache')]
+    cors_headers = _cors_decision(origin)[2]
+    if cors_headers:
+        headers.extend(item for item in cors_headers.items() if item[0] != 'Vary')
+        headers.append(('Vary', 'Origin, Accept-Encoding'))
+    else:
+        headers.append(('Vary', 'Accept-Encoding'))
 
-    # --- Format the displayed allowed origins ---
-    # (Ensure allowed_origins is defined earlier in the function)
-    escaped_origins_list = [html.escape(o) for o in allowed_origins]
-    if escaped_origins_list == ['*']:
-        allowed_origins_display = "<code>*</code> (Any origin - less secure)"
+    # Conditional GET: an unchanged page is answered with an empty 304
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers=headers)
+
+    # Create the response with the HTML (body is UTF-8 bytes)
+    headers.append(('Content-Type', 'text/html; charset=utf-8'))
+    if use_gzip:
+        headers.append(('Content-Encoding', 'gzip'))
+    return Response(html_bytes, headers=headers)
+
+def _first_choice_message(resp_json):
+    """
+    Returns resp_json['choices'][0]['message'] from an OpenAI chat completion if it is present
+    and well-formed (a dict containing 'content'), otherwise None.
+    """
+    choices = resp_json.get('choices') if isinstance(resp_json, dict) else None
+    if not choices or not isinstance(choices, list) or not isinstance(choices[0], dict):
+        return None
+    message = choices[0].get('message')
+    if not isinstance(message, dict) or 'content' not in message:
+        return None
+    return message
+
+def _json_response(obj, status, headers=None):
+    """
+    Builds a JSON response in one step: orjson-serialized body (or an already serialized bytes
+    body, such as the prebuilt _ERR_* constants), JSON content type, and any extra headers
+    (e.g. the CORS headers chosen for the request).
+    """
+    body = obj if isinstance(obj, bytes) else orjson.dumps(obj)
+    return Response(body, status=status, mimetype='application/json', headers=headers)
+
+# Clients reuse a handful of distinct temperature/seed values, so parsing is memoized. Only JSON
+# scalars are used as cache keys (lists/dicts are unhashable and never valid anyway); typed=True
+# keeps e.g. True, 1 and 1.0 apart. Warnings for an invalid value are logged on its first occurrence.
+_PARSE_CACHE_TYPES = (str, int, float)
+
+def _parse_temperature(value):
+    """
+    Returns the temperature to send to OpenAI for the frontend's value (memoized for scalars).
+    """
+    if isinstance(value, _PARSE_CACHE_TYPES):
+        return _parse_temperature_value(value)
+    return _parse_temperature_value.__wrapped__(value)
+
+def _parse_seed(value):
+    """
+    Returns the seed to send to OpenAI for the frontend's value (memoized for scalars).
+    """
+    if isinstance(value, _PARSE_CACHE_TYPES):
+        return _parse_seed_value(value)
+    return _parse_seed_value.__wrapped__(value)
+
+@functools.lru_cache(maxsize=128, typed=True)
+def _parse_temperature_value(value):
+    """
+    Returns the temperature to send to OpenAI for the frontend's value: the value as a float if it
+    is within [0, 2], otherwise the default of 1.0. JSON numbers (the usual case) are range-checked
+    directly; only other types go through float() with exception handling.
+    """
+    if value is None:
+        return 1.0 # Default temperature
+    if isinstance(value, (int, float)):
+        parsed_temp = float(value)
     else:
-        allowed_origins_display = ", ".join(f"<code>{o}</code>" for o in escaped_origins_list)
-        if not allowed_origins_display:
-             allowed_origins_display = "<i>None specified (CORS likely misconfigured/denied)</i>"
-
-    # --- Generate Simplified HTML Page ---
-    # Uses only: backend_url_for_qualtrics, allowed_origins_display
-    display_html = f"""
-    <!DOCTYPE html><html lang="en">
-    <head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>LUCID Backend Deployed</title>
-    <style>
-        body {{ font-family: system-ui, -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Oxygen, Ubuntu, Cantarell, "Fira Sans", "Droid Sans", "Helvetica Neue", sans-serif; padding: 20px; line-height: 1.6; background-color: #f8f9fa; color: #212529; }}
-        .container {{ max-width: 750px; margin: 40px auto; padding: 35px; border: 1px solid #dee2e6; border-radius: 8px; background-color: #ffffff; box-shadow: 0 4px 8px rgba(0,0,0,0.05); }}
-        h1 {{ color: #0d6efd; border-bottom: 2px solid #0d6efd; padding-bottom: 10px; margin-bottom: 20px; }}
-        h2 {{ color: #495057; margin-top: 30px; border-bottom: 1px solid #ced4da; padding-bottom: 8px;}}
-        code {{ background-color: #e9ecef; padding: 0.2em 0.5em; border-radius: 4px; font-family: "SFMono-Regular", Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace; font-size: 0.9em; color: #d63384;}}
-        .url-box {{ background-color: #f1f3f5; padding: 12px 18px; border: 1px solid #adb5bd; border-radius: 5px; font-family: "SFMono-Regular", Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace; word-wrap: break-word; margin-bottom: 15px; font-size: 1.05em; color: #0b5ed7; }}
-        button {{ padding: 10px 18px; cursor: pointer; border-radius: 5px; border: none; background-color: #0d6efd; color: white; font-size: 15px; transition: background-color 0.2s ease; }}
-        button:hover {{ background-color: #0b5ed7; }}
-        .copied-message {{ color: #198754; font-weight: bold; display: none; margin-left: 10px;}}
-        .important {{ background-color: #fff3cd; border: 1px solid #ffeeba; color: #664d03; padding: 15px 20px; border-radius: 5px; margin-top: 20px; }}
-        .important code {{ background-color: #fde7a0; color: #664d03; }}
-        ul {{ margin-top: 10px; padding-left: 20px; }} li {{ margin-bottom: 5px; }}
-        p {{ margin-bottom: 1rem; }}
-    </style>
-    </head>
-    <body><div class="container">
-        <h1>LUCID Backend Successfully Deployed!</h1>
-
-        <h2>Next Step: Configure Qualtrics</h2>
-        <p>To connect your Qualtrics survey to this backend:</p>
-        <ol>
-            <li><strong>Copy the full Backend URL below.</strong> This URL should reflect the main production domain when accessed via production. Use this URL for the <code>LUCIDBackendURL</code> Embedded Data field in Qualtrics.</li>
-            <li>In your Qualtrics Survey Flow, create or update the Embedded Data field named <code>LUCIDBackendURL</code> and paste this URL as its value.</li>
-        </ol>
-        <p><strong>Backend URL (Value for <code>LUCIDBackendURL</code>):</strong></p>
-        <div id="qualtricsUrlBox" class="url-box">{backend_url_for_qualtrics}</div>
-        <button onclick="copyUrl()">Copy Backend URL</button>
-        <span id="copiedMsg" class="copied-message">Copied!</span>
-    </div>
-    <script>function copyUrl() {{ const urlText = document.getElementById('qualtricsUrlBox').innerText; navigator.clipboard.writeText(urlText).then(() => {{ const msg = document.getElementById('copiedMsg'); msg.style.display = 'inline'; setTimeout(() => {{ msg.style.display = 'none'; }}, 2500); }}).catch(err => {{ console.error('Failed to copy: ', err); alert('Failed to copy URL.'); }}); }}</script>
-    </body></html>
-    """
-
-    # Create Flask response object with the HTML
-    resp = make_response(display_html)
-    resp.headers['Content-Type'] = 'text/html' # Set correct MIME type
-
-    # Apply basic CORS headers for the root route as well (GET requests usually simpler)
-    origin_to_send = None
-    send_credentials_get = False # Renamed variable to avoid conflict
-    if '*' in allowed_origins:
-        origin_to_send = '*'
-    elif origin and origin in allowed_origins:
-        origin_to_send = origin
-        send_credentials_get = True # Allow credentials if specific origin matches
-    if origin_to_send:
-        resp.headers['Access-Control-Allow-Origin'] = origin_to_send
-        resp.headers['Vary'] = 'Origin'
-        # Only add credentials header if needed and true
-        if send_credentials_get:
-            resp.headers['Access-Control-Allow-Credentials'] = 'true'
-    return resp
+        try:
+            parsed_temp = float(value)
+        except (ValueError, TypeError):
+            logger.warning("[/lucid] Invalid temp format ('%s'), using default.", value)
+            return 1.0
+    if 0.0 <= parsed_temp <= 2.0:
+        return parsed_temp
+    logger.warning("[/lucid] Temp '%s' out of range, using default.", parsed_temp)
+    return 1.0
+
+@functools.lru_cache(maxsize=128, typed=True)
+def _parse_seed_value(value):
+    """
+    Returns the seed to send to OpenAI for the frontend's value as an int, or None (OpenAI handles
+    randomness) if no valid seed was given. JSON integers are returned as-is without exception handling.
+    """
+    if value is None or type(value) is int: # (bools go through int() below, as before)
+        return value
+    try:
+        parsed_seed = int(value)
+    except (ValueError, TypeError, OverflowError):
+        logger.warning("[/lucid] Invalid seed format ('%s'), using default (None).", value)
+        return None
+    # Numeric strings can exceed what JSON (and OpenAI) accept as an integer
+    if not -2**63 <= parsed_seed < 2**64:
+        logger.warning("[/lucid] Seed '%s' out of range, using default (None).", value)
+        return None
+    return parsed_seed
 
 @app.route('/lucid', methods=['POST'])
 def lucid():
@@ -219,218 +517,248 @@ def lucid():
     """
     # --- Step 1: CORS Check for POST request ---
     origin = request.headers.get('Origin')
-    allowed_origins = get_allowed_origins_config()
-    print(f"[DEBUG POST /lucid] Request Origin: '{origin}' vs Allowed: {allowed_origins}") # Vercel Log
-
-    origin_to_send = None # Header value for Access-Control-Allow-Origin
-    # 'allow_credentials_post' will determine if the 'Access-Control-Allow-Credentials' header is sent
-    allow_credentials_post = False # Default to false, set true only for specific allowed origins
-    is_request_allowed = False # Flag to track if request passes CORS check
-
-    # Determine if the request origin is permitted
-    if '*' in allowed_origins:
-        origin_to_send = '*'
-        is_request_allowed = True
-        allow_credentials_post = False # Cannot use credentials with wildcard
-        print("[DEBUG POST /lucid] Policy: Allowed Wildcard (*), Credentials False") # Vercel Log
-    elif origin and origin in allowed_origins:
-        origin_to_send = origin
-        is_request_allowed = True
-        allow_credentials_post = True # Allow credentials for specific origins
-        print(f"[DEBUG POST /lucid] Policy: Allowed Specific Origin ({origin}), Credentials True") # Vercel Log
-    else:
-        # Origin is not in the allowed list (and not wildcard)
-        is_request_allowed = False
-        print(f"[DEBUG POST /lucid] Policy: Denied Origin ({origin})") # Vercel Log
-
-    # If CORS check fails, return 403 Forbidden immediately
-    if not is_request_allowed:
-        print(f"[WARN] POST to /lucid denied for origin: {origin}.") # Vercel Log
-        error_resp = make_response(jsonify({'error': 'Forbidden', 'message': 'Origin not permitted.'}), 403)
-        # Add CORS headers even on error where possible, though browser might ignore on 403
-        if origin_to_send:
-             error_resp.headers['Access-Control-Allow-Origin'] = origin_to_send
-             error_resp.headers['Vary'] = 'Origin'
-             # Only add credentials header if needed and true
-             if allow_credentials_post:
-                 error_resp.headers['Access-Control-Allow-Credentials'] = 'true'
-        return error_resp
-    # --- End CORS Check ---
 
-    # --- Step 2: Process Request Body ---
-    print(f"[INFO] ------ Entered lucid function from allowed origin: {origin} ------") # Vercel Log
-    post_data = request.data # Get raw request body
-    print(f"[INFO /lucid] Received {len(post_data)} bytes.") # Vercel Log
+    # Determine if the request origin is permitted, and pick the CORS headers for every response below
+    # (credentials are only allowed for specific origins, never with the wildcard). _LucidFastPath
+    # has normally already made this decision and stored it in the environ, so it is reused here.
+    cors = request.environ.get('lucid.cors')
+    if cors is None:
+        cors = _cors_decision(origin)
+    origin_to_send, allow_credentials_post, cors_headers = cors
+    logger.debug("[POST /lucid] Origin '%s' vs Allowed %s: Allow-Origin %s, Credentials %s",
+                 origin, _ALLOWED_ORIGINS, origin_to_send, allow_credentials_post)
+    if origin_to_send is None:
+        # Origin is not in the allowed list (and not wildcard): return 403 Forbidden immediately.
+        # _LucidFastPath normally rejects these before Flask runs; this is a backstop.
+        logger.warning("POST to /lucid denied for origin: %s.", origin)
+        return _json_response(_ERR_FORBIDDEN, 403)
+    # --- End CORS Check ---
 
-    response_data = {} # Dictionary to hold the JSON response data
+    # --- Step 2: Check for API Key (read once at startup) ---
+    # Checked before the body is read or parsed, since no request can succeed without it
+    if not _OPENAI_API_KEY:
+        logger.critical('[/lucid] OpenAI API key not found in environment variables (checked OPENAI_API_KEY and openai_api_key).')
+        return _json_response(_ERR_NO_KEY, 500, cors_headers)
+
+    # --- Step 3: Process Request Body ---
+    # Reject oversized payloads from the declared Content-Length, before buffering or parsing the body
+    # (a body sent without Content-Length is checked after reading, below)
+    if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        logger.warning("[/lucid] Payload too large (%s bytes).", request.content_length)
+        return _json_response(_ERR_BODY_TOO_LARGE, 413, cors_headers)
+
+    # Get raw request body; cache=False skips keeping a second copy on the request object
+    post_data = request.get_data(cache=False)
+    logger.info("[/lucid] Received %s bytes.", len(post_data))
+    # Without a Content-Length, Werkzeug silently truncates the body at MAX_CONTENT_LENGTH; a body
+    # that reached the limit is treated as oversized rather than parsed in truncated form
+    if request.content_length is None and len(post_data) >= app.config['MAX_CONTENT_LENGTH']:
+        logger.warning("[/lucid] Payload too large (body without Content-Length reached %s bytes).", len(post_data))
+        return _json_response(_ERR_BODY_TOO_LARGE, 413, cors_headers)
+
+    response_data = _ERR_INTERNAL # JSON response data: a dict, or prebuilt bytes for fixed errors
     status_code = 500  # Default to Internal Server Error
 
     try:
-        # Decode body as UTF-8 and parse JSON
-        body = json.loads(post_data.decode('utf-8'))
-
-        # --- Step 3: Get and Check for API Key ---
-        # UPDATED: Check for both uppercase and lowercase env var names
-        openai_api_key = (
-            os.getenv('OPENAI_API_KEY') or  # Vercel / production (Screaming Snake Case)
-            os.getenv('openai_api_key')     # legacy/local (lower snake case)
-        )
-
-        # Basic check/log for the API key (without exposing the key itself)
-        if isinstance(openai_api_key, str) and len(openai_api_key) > 7:
-            print(f"[DIAGNOSTIC /lucid] API Key Found (Length: {len(openai_api_key)}).") # Vercel Log
-        elif not openai_api_key:
-            print("[CRITICAL DIAGNOSTIC /lucid] Neither os.getenv('OPENAI_API_KEY') nor os.getenv('openai_api_key') returned a value!") # Vercel Log
-
-        # --- Check if API Key is actually present ---
-        if not openai_api_key:
-            print('[CRITICAL /lucid] OpenAI API key not found in environment variables (checked OPENAI_API_KEY and openai_api_key).') # Vercel Log
-            # Set error response if key is missing
-            response_data = {'error': 'Configuration Error', 'message':'OpenAI API key not configured on server.'}
-            status_code = 500 # Indicate server configuration error
+        # Parse JSON directly from the raw UTF-8 bytes (no intermediate str)
+        body = orjson.loads(post_data)
+
+        # Extract parameters sent from Qualtrics frontend
+        model = body.get('model', 'gpt-4o') # Use model from request, default to gpt-4o if not sent (JS usually sends its default)
+        messages = body.get('messages', []) # Get message history array
+        temp_from_frontend = body.get('temperature') # Get optional temperature
+        seed_from_frontend = body.get('seed') # Get optional seed
+
+        # Validate messages list (must not be empty)
+        if not messages or not isinstance(messages, list):
+            logger.warning("[/lucid] Invalid or empty 'messages' list received.")
+            response_data = _ERR_EMPTY_MESSAGES
+            status_code = 400 # Bad Request
+        elif len(messages) > _MAX_MESSAGES:
+            # Bound the size of the conversation sent upstream (and thus OpenAI latency)
+            logger.warning("[/lucid] Too many messages (%s > %s).", len(messages), _MAX_MESSAGES)
+            response_data = _ERR_TOO_MANY_MESSAGES
+            status_code = 413
         else:
-            # API Key found, proceed to extract data and call OpenAI
-
-            # Extract parameters sent from Qualtrics frontend
-            model = body.get('model', 'gpt-4o') # Use model from request, default to gpt-4o if not sent (JS usually sends its default)
-            messages = body.get('messages', []) # Get message history array
-            temp_from_frontend = body.get('temperature') # Get optional temperature
-            seed_from_frontend = body.get('seed') # Get optional seed
-
-            # Validate messages list (must not be empty)
-            if not messages or not isinstance(messages, list):
-                print("[WARN /lucid] Invalid or empty 'messages' list received.") # Vercel Log
-                response_data = {'error': 'Bad Request', 'message': 'Messages list is missing, empty, or invalid.'}
-                status_code = 400 # Bad Request
-            else:
-                # Process temperature (use value from frontend if valid, otherwise default to 1.0)
-                used_temperature = 1.0 # Default temperature
-                if temp_from_frontend is not None:
-                    try:
-                        parsed_temp = float(temp_from_frontend)
-                        if 0.0 <= parsed_temp <= 2.0: used_temperature = parsed_temp
-                        else: print(f"[WARN /lucid] Temp '{parsed_temp}' out of range, using default.") # Vercel Log
-                    except (ValueError, TypeError): print(f"[WARN /lucid] Invalid temp format ('{temp_from_frontend}'), using default.") # Vercel Log
-                print(f"[INFO /lucid] Using temperature: {used_temperature}") # Vercel Log
-
-                # Process seed (use value from frontend if valid, otherwise default to None)
-                used_seed = None # Default: OpenAI handles randomness
-                if seed_from_frontend is not None:
-                    try: used_seed = int(seed_from_frontend)
-                    except (ValueError, TypeError): print(f"[WARN /lucid] Invalid seed format ('{seed_from_frontend}'), using default (None).") # Vercel Log
-                print(f"[INFO /lucid] Using seed: {used_seed}") # Vercel Log
-
-                # --- Step 4: Call OpenAI API ---
-                openai_url = 'https://api.openai.com/v1/chat/completions'
-                headers = {
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Bearer {openai_api_key}' # Use API key for authorization
-                }
-                # Construct payload for OpenAI
-                data_payload = {
-                    'model': model,
-                    'messages': messages,
-                    'temperature': used_temperature
+            # Process temperature and seed (use values from frontend if valid, otherwise defaults)
+            used_temperature = _parse_temperature(temp_from_frontend)
+            used_seed = _parse_seed(seed_from_frontend)
+
+            # --- Step 4: Call OpenAI API ---
+            # Construct payload for OpenAI
+            data_payload = {
+                'model': model,
+                'messages': messages,
+                'temperature': used_temperature
+            }
+            # Only include seed if one was provided and valid
+            if used_seed is not None:
+                data_payload['seed'] = used_seed
+
+            logger.info("[/lucid] Calling OpenAI API (model: %s, temperature: %s, seed: %s).", model, used_temperature, used_seed)
+
+            # Serialized once with orjson; the same bytes are hashed for the cache and sent upstream
+            payload_bytes = orjson.dumps(data_payload)
+
+            # Seeded requests may be answered from the opt-in response cache
+            cache_key = _response_cache_key(payload_bytes) if used_seed is not None else None
+            cached_text = _response_cache_get(cache_key)
+            if cached_text is not None:
+                logger.info("[/lucid] Response cache hit; skipping OpenAI call.")
+                response_data = {
+                    'generated_text': cached_text,
+                    'used_temperature': used_temperature,
+                    'used_seed': used_seed
                 }
-                # Only include seed if one was provided and valid
-                if used_seed is not None:
-                    data_payload['seed'] = used_seed
-
-                print(f"[INFO /lucid] Calling OpenAI API (model: {model}). Payload keys: {list(data_payload.keys())}") # Vercel Log
-
+                status_code = 200 # OK
+            else:
                 # Make the POST request to OpenAI with a timeout
-                response_openai = requests.post(openai_url, headers=headers, json=data_payload, timeout=30)
+                response_openai = _SESSION.post(_OPENAI_URL, data=payload_bytes, timeout=30)
                 openai_status = response_openai.status_code
-                openai_response_text = response_openai.text # Get raw text for potential error logging
-                print(f"[INFO /lucid] OpenAI response status: {openai_status}") # Vercel Log
+                logger.info("[/lucid] OpenAI response status: %s", openai_status)
 
                 # --- Step 5: Process OpenAI Response ---
                 if openai_status == 200:
                     # Successful call
-                    print("[INFO /lucid] Successfully processed OpenAI response.") # Vercel Log
+                    # Parse the JSON response from OpenAI straight from the raw bytes, then extract
+                    # the generated text with guarded lookups (no exception-driven control flow)
                     try:
-                        # Parse the JSON response from OpenAI
-                        resp_json = response_openai.json()
-                        # Extract the generated text content safely
-                        generated_text = resp_json['choices'][0]['message']['content']
+                        resp_json = orjson.loads(response_openai.content)
+                    except orjson.JSONDecodeError:
+                        resp_json = None
+                    message = _first_choice_message(resp_json)
 
+                    if message is not None:
                         # Prepare the successful response data for Qualtrics frontend
                         response_data = {
-                            'generated_text': generated_text,
+                            'generated_text': message.get('content'),
                             'used_temperature': used_temperature # Echo back parameters used
                         }
                         if used_seed is not None:
                             response_data['used_seed'] = used_seed # Echo back seed if used
 
                         status_code = 200 # OK
-                    except (KeyError, IndexError, TypeError, json.JSONDecodeError) as e:
+                        _response_cache_put(cache_key, response_data['generated_text'])
+                    else:
                         # Handle cases where OpenAI gives 200 but response format is unexpected
-                        print(f"[ERROR /lucid] OpenAI response format unexpected (Status 200): {openai_response_text} - Error: {e}") # Vercel Log
-                        response_data = {'error': 'Internal Server Error', 'message': 'Invalid response format from AI service.'}
+                        logger.error("[/lucid] OpenAI response format unexpected (Status 200): %s", response_openai.text)
+                        response_data = _ERR_BAD_UPSTREAM_FORMAT
                         status_code = 500
                 else:
                     # Handle error responses from OpenAI (non-200 status)
-                    print(f"[ERROR DIAGNOSTIC /lucid] OpenAI API Error ({openai_status}): {openai_response_text}") # Vercel Log
-                    # Try to extract a cleaner error message from OpenAI's response JSON
-                    error_details = openai_response_text
+                    # Parse the raw bytes once for OpenAI's error message; the body is only decoded to
+                    # text as a fallback when it is not the usual {"error": {"message": ...}} JSON
                     try:
-                       error_json = response_openai.json()
-                       if 'error' in error_json and 'message' in error_json['error']:
-                           error_details = error_json['error']['message']
-                    except json.JSONDecodeError:
-                        pass # Use raw text if parsing fails
+                        error_json = orjson.loads(response_openai.content)
+                    except orjson.JSONDecodeError:
+                        error_json = None
+                    error_obj = error_json.get('error') if isinstance(error_json, dict) else None
+                    if isinstance(error_obj, dict) and 'message' in error_obj:
+                        error_details = error_obj['message']
+                    else:
+                        error_details = response_openai.text # Use raw text if parsing fails
+                    logger.error("[/lucid] OpenAI API Error (%s): %s", openai_status, error_details)
                     response_data = {'error': f'AI Service Error ({openai_status})', 'message': error_details}
                     # Use OpenAI's status code if it's a standard error, otherwise default to 500
                     status_code = openai_status if openai_status < 600 else 500
 
     # --- Step 6: Handle Exceptions during Request Processing ---
     except requests.exceptions.Timeout:
-        print("[ERROR /lucid] Request to OpenAI timed out.") # Vercel Log
-        response_data = {'error': 'Gateway Timeout', 'message': 'Request to AI service timed out.'}
+        logger.error("[/lucid] Request to OpenAI timed out.")
+        response_data = _ERR_TIMEOUT
         status_code = 504 # Gateway Timeout
     except requests.exceptions.RequestException as e:
         # Handle network errors connecting to OpenAI
-        print(f"[ERROR /lucid] Network error connecting to OpenAI: {e}") # Vercel Log
-        response_data = {'error': 'Service Unavailable', 'message': 'Network error connecting to AI service.'}
+        logger.error("[/lucid] Network error connecting to OpenAI: %s", e)
+        response_data = _ERR_NETWORK
         status_code = 503 # Service Unavailable
-    except json.JSONDecodeError:
-        # Handle invalid JSON sent from the frontend
-        print(f"[ERROR /lucid] Invalid JSON received from client.") # Vercel Log
-        response_data = {'error': 'Bad Request', 'message': 'Invalid JSON format in request body.'}
+    except orjson.JSONDecodeError:
+        # Handle invalid JSON (or invalid UTF-8) sent from the frontend
+        logger.error("[/lucid] Invalid JSON received from client.")
+        response_data = _ERR_BAD_JSON
         status_code = 400 # Bad Request
     except Exception as e:
         # Catch-all for any other unexpected errors
-        print(f"[ERROR /lucid] Unexpected server error: {e.__class__.__name__}: {e}") # Vercel Log
-        # Consider logging the full traceback here if possible in production
-        import traceback
-        traceback.print_exc() # Print traceback to logs
-        response_data = {'error': 'Internal Server Error', 'message': f'An unexpected error occurred processing the request.'}
+        # logger.exception records the full traceback through the logging handler (no stdout printing)
+        logger.exception("[/lucid] Unexpected server error: %s: %s", e.__class__.__name__, e)
+        response_data = _ERR_INTERNAL
         status_code = 500
 
     # --- Step 7: Create and Return Final Flask Response ---
-    final_response = make_response(jsonify(response_data), status_code)
+    # Built in one step: orjson body, JSON content type, and the CORS headers chosen in Step 1
+    # ('Vary: Origin' is important for caching proxies; Access-Control-Allow-Credentials is only
+    # present, as 'true', for specific allowed origins).
+    logger.info("[/lucid] Responding with status code: %s", status_code)
+    return _json_response(response_data, status_code, cors_headers)
 
-    # Add required CORS headers to the actual response
-    final_response.headers['Access-Control-Allow-Origin'] = origin_to_send
-    final_response.headers['Vary'] = 'Origin' # Important for caching proxies
+# --- WSGI Middleware ---
 
-    # UPDATED: Only add Access-Control-Allow-Credentials header if it should be 'true'
-    if allow_credentials_post: # This boolean reflects the decision made earlier
-        final_response.headers['Access-Control-Allow-Credentials'] = 'true'
-        print("[DEBUG POST /lucid] Adding Access-Control-Allow-Credentials: true to final response") # Vercel Log
-    else:
-        print("[DEBUG POST /lucid] Not adding Access-Control-Allow-Credentials header to final response") # Vercel Log
+_PREFLIGHT_DENIED_BODY = b'Origin not permitted for CORS preflight'
+
+class _LucidFastPath:
+    """
+    WSGI middleware that answers CORS preflight (OPTIONS /lucid) requests directly from the
+    memoized CORS policy and header caches, without Flask creating a request context, running
+    hooks, or matching URLs. Checks the request's Origin header against the ALLOWED_ORIGINS config
+    and returns a 204 with the appropriate CORS headers if allowed (echoing back requested headers,
+    and only adding 'Access-Control-Allow-Credentials: true' when needed), or a 403 if denied.
+    POSTs to /lucid from a disallowed origin are likewise rejected here with a 403, before their
+    body is read. All other requests are passed through to the Flask app unchanged.
+    """
 
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        # Intercept only OPTIONS requests targetting the main API endpoint
+        if environ.get('REQUEST_METHOD') == 'OPTIONS' and environ.get('PATH_INFO') == '/lucid':
+            return self._preflight(environ, start_response)
+        # Reject POSTs from disallowed origins before Flask reads (and buffers) the request body
+        if environ.get('REQUEST_METHOD') == 'POST' and environ.get('PATH_INFO') == '/lucid':
+            origin = environ.get('HTTP_ORIGIN')
+            cors = environ['lucid.cors'] = _cors_decision(origin) # Reused by the view (one evaluation per request)
+            if cors[0] is None:
+                logger.warning("POST to /lucid denied for origin: %s.", origin)
+                start_response('403 FORBIDDEN', [('Content-Type', 'application/json'),
+                                                 ('Content-Length', str(len(_ERR_FORBIDDEN)))])
+                return [_ERR_FORBIDDEN]
+        return self.wsgi_app(environ, start_response)
+
+    @staticmethod
+    def _preflight(environ, start_response):
+        origin = environ.get('HTTP_ORIGIN') # Get the origin of the requesting domain
+
+        # ---- decide origin & credentials ------------------------
+        ac_allow_origin, send_credentials, _ = _cors_decision(origin)
+        logger.debug("[PREFLIGHT] Origin '%s' vs Allowed %s: Allow-Origin %s, Credentials %s",
+                     origin, _ALLOWED_ORIGINS, ac_allow_origin, send_credentials)
+        if ac_allow_origin is None:
+            # Origin not allowed by configuration (a missing origin is never allowed)
+            logger.warning("Preflight origin '%s' denied by policy for /lucid.", origin)
+            start_response('403 FORBIDDEN', [('Content-Type', 'text/plain; charset=utf-8'),
+                                             ('Content-Length', str(len(_PREFLIGHT_DENIED_BODY)))])
+            return [_PREFLIGHT_DENIED_BODY]
+
+        # ---- echo back ALL requested headers --------------------
+        # Headers the browser wants to send in the actual request,
+        # e.g. "X-Requested-With,Content-Type" or just "Content-Type" etc.
+        req_hdrs = environ.get('HTTP_ACCESS_CONTROL_REQUEST_HEADERS', '')
+        logger.debug("[PREFLIGHT] Access-Control-Request-Headers received: '%s'", req_hdrs)
 
-    final_response.headers['Content-Type'] = 'application/json' # Ensure correct content type
+        # Respond 204 No Content with the memoized headers
+        headers = _preflight_headers(ac_allow_origin, send_credentials, req_hdrs)
+        logger.info("Preflight OK for /lucid. Sending 204 with headers: %s", headers)
+        start_response('204 NO CONTENT', list(headers))
+        return [b'']
 
-    print(f"[INFO /lucid] Responding with status code: {status_code}") # Vercel Log
-    return final_response
+# Wrap the Flask app in place, so `app` (the entry point Vercel and Gunicorn load) includes the fast path
+app.wsgi_app = _LucidFastPath(app.wsgi_app)
 
 # --- Main Execution Block (for local development) ---
 if __name__ == '__main__':
     # This block only runs when the script is executed directly (e.g., `python lucid_api.py`)
     # It's ignored when run by a WSGI server like Vercel's Python runtime.
+    # For self-hosted production use Gunicorn instead: `gunicorn -c gunicorn.conf.py lucid:app`
     print("[INFO] Starting Flask development server...")
 
     # Optional: Set environment variables locally for testing
@@ -439,6 +767,8 @@ if __name__ == '__main__':
     # os.environ['VERCEL_URL'] = 'localhost:8080' # Example for testing the root page
 
     # Run the Flask development server
-    # Debug=True enables auto-reloading and provides detailed error pages (DO NOT use in production)
+    # Debug mode (auto-reloading and detailed error pages) is opt-in: without a debug argument,
+    # app.run reads FLASK_DEBUG itself, so the dev server never exposes the interactive debugger
+    # by accident (DO NOT enable it in production)
     local_port = int(os.getenv('PORT', 8080)) # Use PORT env var if set, otherwise default to 8080
-    app.run(debug=True, port=local_port, host='0.0.0.0') # Host 0.0.0.0 makes it accessible on network
\ No newline at end of file
+    app.run(port=local_port, host='0.0.0.0') # Host 0.0.0.0 makes it accessible on network
\ No newline at end of file